@@ -4,22 +4,64 @@ See README.md for quick-start commands and HTTP endpoints.
 
 from __future__ import annotations
 
+import asyncio
+import fcntl
+import functools
+import hashlib
+import inspect
+import json
 import logging
+import math
 import os
 import pathlib
-import random
-from typing import List
+import pickle
+import re
+import shutil
+import tempfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from typing import AsyncIterator, Callable, Dict, List, Tuple
 
+def _cpu_quota(root: pathlib.Path = pathlib.Path("/sys/fs/cgroup")) -> int | None:
+    """Whole CPUs granted by the cgroup quota (docker --cpus, k8s limits), or None if unlimited."""
+    try:  # cgroup v2: "<quota> <period>" or "max <period>"
+        quota, period = (root / "cpu.max").read_text().split()
+        return None if quota == "max" else max(1, int(quota) // int(period))
+    except (OSError, ValueError):
+        pass
+    try:  # cgroup v1: quota is -1 when unlimited
+        quota = int((root / "cpu" / "cpu.cfs_quota_us").read_text())
+        period = int((root / "cpu" / "cpu.cfs_period_us").read_text())
+        return None if quota <= 0 else max(1, quota // period)
+    except (OSError, ValueError):
+        return None
+
+
+# OpenMP/BLAS pools size themselves when first loaded, so split the cores
+# between uvicorn workers (WEB_CONCURRENCY) before faiss/numpy/torch import
+_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+if (_quota := _cpu_quota()) is not None:  # affinity ignores it: a --cpus=2 container still sees every host core
+    _CPUS = min(_CPUS, _quota)
+NUM_THREADS = int(os.getenv("NUM_THREADS", max(1, _CPUS // max(1, int(os.getenv("WEB_CONCURRENCY", "1"))))))
+os.environ.setdefault("OMP_NUM_THREADS", str(NUM_THREADS))
+
+import faiss
+import numpy as np
 from fastapi import FastAPI, Query
 from langchain.embeddings import HuggingFaceEmbeddings
 from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader, TextLoader
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.embeddings import Embeddings
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
 from contextlib import asynccontextmanager
 from fastapi import Request
-
-import g4f  # GPT-4-free chat backend
+from fastapi.responses import StreamingResponse
 
 
 # ─────────────────────────── Config & logging ────────────────────────────────
@@ -27,9 +69,29 @@ ROOT = pathlib.Path(__file__).parent
 DOCS_DIR = ROOT / "documents"
 VECTOR_PATH = pathlib.Path(os.getenv("VECTOR_PATH", ROOT / "faiss_index"))
 EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "onnx")  # "onnx" (ONNX Runtime) or "torch"
+ONNX_DIR = pathlib.Path(os.getenv("ONNX_DIR", "/tmp/onnx_cache"))
+ORT_PROVIDER = os.getenv("ORT_PROVIDER", "CPUExecutionProvider")  # e.g. CUDAExecutionProvider
+EMBED_QUANTIZE = os.getenv("EMBED_QUANTIZE", "0") == "1"  # dynamic INT8 weights
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
+EMBED_FP16 = os.getenv("EMBED_FP16", "1") == "1"  # half-precision torch encoder (GPU only)
 CHUNK_SIZE = 800
 K = 8  # retrieved chunks
+CONTEXT_SENTENCES = int(os.getenv("CONTEXT_SENTENCES", "4"))  # kept per chunk; 0 = whole chunks
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "256"))
+G4F_PROVIDER = os.getenv("G4F_PROVIDER")  # g4f.Provider attribute name; unset = let g4f choose
+FAISS_INDEX = os.getenv("FAISS_INDEX", "ivfpq")  # key of INDEX_PRESETS
+NLIST = int(os.getenv("NLIST", "1024"))  # upper bound on IVF centroids
+NPROBE = int(os.getenv("NPROBE", "16"))  # IVF lists scanned per query
+REBUILD_GROWTH = float(os.getenv("REBUILD_GROWTH", "2"))  # retrain once the corpus grows/shrinks by this factor
+EF_CONSTRUCTION = int(os.getenv("EF_CONSTRUCTION", "200"))  # HNSW build-time beam width
+EF_SEARCH = int(os.getenv("EF_SEARCH", "64"))  # HNSW query-time beam width (>= K)
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))  # how long to wait for more queries
+MAX_BATCH = int(os.getenv("MAX_BATCH", "32"))  # queries per FAISS search call
+SIM_THRESHOLD = float(os.getenv("SIM_THRESHOLD", "0.92"))  # cosine similarity for a cache hit
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "1024"))  # answers kept per semantic cache
+REDIS_URL = os.getenv("REDIS_URL")  # e.g. redis://localhost:6379/0; unset = no search cache
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))  # seconds
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s | %(name)s | %(message)s")
 log = logging.getLogger("rag_demo_g4f_clean")
@@ -38,92 +100,906 @@ log = logging.getLogger("rag_demo_g4f_clean")
 
 TEXT_SUFFIXES = {".txt", ".md", ".rst", ".log", ".csv"}
 
-def loader_for(path: pathlib.Path):
-    if path.suffix.lower() == ".pdf":
-        return PyPDFLoader(str(path))
-    if path.suffix.lower() in TEXT_SUFFIXES:
-        return TextLoader(str(path), encoding="utf-8", errors="ignore")
-    return None  # skip binaries
+
+def _text_loader(path: str) -> TextLoader:
+    return TextLoader(path, encoding="utf-8", autodetect_encoding=True)
+
+
+# lower-cased suffix → loader factory; anything else is skipped as binary
+LOADERS = {".pdf": PyPDFLoader, **{suffix: _text_loader for suffix in TEXT_SUFFIXES}}
+
+
+def loader_for(path: str):
+    factory = LOADERS.get(os.path.splitext(path)[1].lower())
+    return factory(path) if factory else None
+
+
+def _load_one(path: str) -> List[Document]:
+    loader = loader_for(path)
+    return loader.load() if loader else []
+
+
+FALLBACK_DOCS = [
+    Document("This is a fallback document. Add PDFs or TXT files to ./docs to improve answers.", metadata={"source": "fallback"}),
+]
 
 
-def load_documents(root: pathlib.Path) -> List[Document]:
+def source_files(root: pathlib.Path) -> List[str]:
     if not root.exists():
         log.warning("%s missing – using fallback docs", root)
-        return [
-            Document("This is a fallback document. Add PDFs or TXT files to ./docs to improve answers.", metadata={"source": "fallback"}),
-        ]
-
-    loader = DirectoryLoader(
-        str(root),
-        glob="**/*",
-        loader_cls=lambda p: loader_for(pathlib.Path(p)) or TextLoader("", encoding="utf-8"),
-        use_multithreading=True,
+        return []
+    return sorted(
+        str(p) for p in root.rglob("*")
+        if p.is_file() and not p.name.startswith(".") and p.suffix.lower() in LOADERS
     )
-    docs = loader.load()
-    log.info("Loaded %d raw docs from %s", len(docs), root)
+
+
+def load_files(paths: List[str]) -> List[Document]:
+    pdfs = [p for p in paths if p.lower().endswith(".pdf")]
+    texts = [p for p in paths if not p.lower().endswith(".pdf")]
+
+    docs: List[Document] = []
+    # pypdf is pure Python and CPU-bound → processes; text files are I/O-bound → threads
+    if len(pdfs) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(pdfs), NUM_THREADS)) as pool:
+            for part in pool.map(_load_one, pdfs):
+                docs.extend(part)
+    else:
+        for p in pdfs:
+            docs.extend(_load_one(p))
+    with ThreadPoolExecutor() as pool:
+        for part in pool.map(_load_one, texts):
+            docs.extend(part)
     return docs
 
+# ────────────────────────────── Embeddings ───────────────────────────────────
+
+@contextmanager
+def file_lock(path: pathlib.Path):
+    """Hold an exclusive flock on `path`, so workers starting together take turns."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+EXPORT_MARKER = ".complete"  # written last into a finished ONNX export
+
+
+class OnnxEmbeddings(Embeddings):
+    """Mean-pooled, L2-normalised sentence embeddings served by ONNX Runtime.
+
+    The model is exported (and optionally INT8-quantized) on first use and
+    cached under `export_dir`; later starts load the .onnx file directly.
+    Exports are built in a temp directory and renamed into place under a
+    lock, so concurrent or interrupted starts never see a partial export.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        export_dir: pathlib.Path,
+        provider: str = "CPUExecutionProvider",
+        quantize: bool = False,
+        max_length: int = 256,  # all-MiniLM-L6-v2's max_seq_length
+        batch_size: int = EMBED_BATCH_SIZE,
+        num_threads: int = NUM_THREADS,
+    ):
+        import onnxruntime
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        file_name = "model_quantized.onnx" if quantize else "model.onnx"
+        with file_lock(export_dir.parent / f".{export_dir.name}.lock"):
+            if not (export_dir / EXPORT_MARKER).exists():
+                log.info("Exporting %s to ONNX in %s", model_name, export_dir)
+                with tempfile.TemporaryDirectory(dir=export_dir.parent, prefix=f".{export_dir.name}.") as tmp:
+                    staging = pathlib.Path(tmp) / "export"
+                    ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(staging)
+                    AutoTokenizer.from_pretrained(model_name).save_pretrained(staging)
+                    (staging / EXPORT_MARKER).touch()
+                    shutil.rmtree(export_dir, ignore_errors=True)  # an unmarked, partial export
+                    os.replace(staging, export_dir)
+
+            if not (export_dir / file_name).exists():
+                from optimum.onnxruntime import ORTQuantizer
+                from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+                with tempfile.TemporaryDirectory(dir=export_dir.parent, prefix=f".{export_dir.name}.") as tmp:
+                    ORTQuantizer.from_pretrained(export_dir).quantize(save_dir=tmp, quantization_config=qconfig)
+                    os.replace(pathlib.Path(tmp) / file_name, export_dir / file_name)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            export_dir, file_name=file_name, provider=provider, session_options=options,
+        )
+        self.max_length = max_length
+        self.batch_size = batch_size
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        enc = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np")
+        hidden = self.model(**enc).last_hidden_state
+        mask = enc["attention_mask"][..., None].astype(hidden.dtype)
+        vecs = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return vecs / np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        # smart batching: similar lengths share a batch, so little padding is encoded
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        sorted_texts = [texts[i] for i in order]
+        out = np.concatenate([
+            self._encode(sorted_texts[i:i + self.batch_size])
+            for i in range(0, len(sorted_texts), self.batch_size)
+        ])
+        vecs = np.empty_like(out)
+        vecs[order] = out
+        return vecs.tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def make_embedder() -> Embeddings:
+    if EMBED_BACKEND == "onnx":
+        export_dir = ONNX_DIR / EMBED_MODEL.replace("/", "__")
+        return OnnxEmbeddings(EMBED_MODEL, export_dir, provider=ORT_PROVIDER, quantize=EMBED_QUANTIZE)
+
+    # unit-length vectors so inner product == cosine similarity;
+    # SentenceTransformer.encode already length-sorts each call internally
+    embedder = HuggingFaceEmbeddings(
+        model_name=EMBED_MODEL,
+        cache_folder="/tmp/hf_cache",
+        encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True},
+    )
+    # FP16 halves weight bandwidth on GPU; CPU kernels for half are slower than FP32
+    if EMBED_FP16 and embedder.client.device.type == "cuda":
+        embedder.client.half()
+        log.info("Running %s in FP16", EMBED_MODEL)
+
+    import torch  # already loaded by sentence-transformers
+
+    torch.set_num_threads(NUM_THREADS)
+    return embedder
+
+# ───────────────────────────── Vector index ──────────────────────────────────
+
+# preset → (faiss.index_factory spec, minimum vectors needed to train it).
+# Every index takes explicit ids (IVF natively, the rest through IDMap2) so
+# chunks can be removed without renumbering the survivors.
+INDEX_PRESETS = {
+    "flat": ("IDMap2,Flat", 0),
+    "sqfp16": ("IDMap2,SQfp16", 0),  # 2 B/dim, exact up to half-precision rounding
+    "ivfsq8": ("IVF{nlist},SQ8", 1),  # 1 B/dim, int8 SIMD distance kernels
+    "ivfpq": ("IVF{nlist},PQ32x8", 256),  # 32 B/vector; 8-bit PQ codebooks need 2^8 points
+    "hnsw": ("IDMap2,HNSW32,Flat", 0),  # log-N graph walk over exact vectors; cannot remove chunks
+}
+
+
+def _nlist(n: int) -> int:
+    # faiss wants ~39 training points per centroid
+    return max(1, min(NLIST, n // 39))
+
+
+def resolve_spec(n: int) -> str:
+    """The index_factory spec FAISS_INDEX stands for when built from `n` vectors."""
+    spec, min_train = INDEX_PRESETS[FAISS_INDEX]
+    if n < min_train:
+        spec = INDEX_PRESETS["flat"][0]
+    return spec.format(nlist=_nlist(n))
+
+
+def index_outdated(spec: str, trained_on: int, n: int) -> bool:
+    """Whether an index built as `spec` from `trained_on` vectors should be rebuilt for `n`."""
+    wanted = resolve_spec(n)
+    if wanted == spec:
+        return False
+    if re.sub(r"IVF\d+", "IVF", wanted) != re.sub(r"IVF\d+", "IVF", spec):
+        return True  # e.g. a Flat fallback that the preset can now replace
+    # only nlist differs – retrain centroids/codebooks once the corpus has really moved
+    lo, hi = sorted((max(n, 1), max(trained_on, 1)))
+    return hi >= REBUILD_GROWTH * lo
+
+
+def make_index(vectors: np.ndarray) -> faiss.Index:
+    """Create and train an empty inner-product index for `vectors`."""
+    if len(vectors) < INDEX_PRESETS[FAISS_INDEX][1]:
+        log.warning("Only %d vectors – too few to train %r, falling back to Flat", len(vectors), FAISS_INDEX)
+    index = faiss.index_factory(vectors.shape[1], resolve_spec(len(vectors)), faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        index.train(vectors)
+    if (hnsw := _hnsw(index)) is not None:
+        hnsw.hnsw.efConstruction = EF_CONSTRUCTION
+    return index
+
+
+def _hnsw(index: faiss.Index) -> faiss.IndexHNSW | None:
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+
+def tune_index(index: faiss.Index) -> faiss.Index:
+    """Apply search-time parameters (no-op for indexes without any)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = NPROBE
+    if (hnsw := _hnsw(index)) is not None:
+        hnsw.hnsw.efSearch = max(EF_SEARCH, K)
+    return index
+
+
+def add_chunks(db: FAISS, chunks: List[Document], vectors: np.ndarray, ids: List[str]) -> None:
+    start = max(db.index_to_docstore_id, default=-1) + 1
+    faiss_ids = np.arange(start, start + len(chunks), dtype="int64")
+    db.index.add_with_ids(vectors, faiss_ids)
+    db.docstore.add(dict(zip(ids, chunks)))
+    db.index_to_docstore_id.update(zip(faiss_ids.tolist(), ids))
+
+
+def remove_chunks(db: FAISS, ids: List[str]) -> None:
+    # FAISS.delete renumbers index_to_docstore_id, which only matches indexes
+    # that compact on removal – IVF keeps its ids, so track them explicitly
+    reverse = {doc_id: i for i, doc_id in db.index_to_docstore_id.items()}
+    faiss_ids = [reverse[doc_id] for doc_id in ids if doc_id in reverse]
+    if not faiss_ids:
+        return
+    db.index.remove_ids(np.array(faiss_ids, dtype="int64"))
+    db.docstore.delete([db.index_to_docstore_id.pop(i) for i in faiss_ids])
+
+
+def embed_chunks(chunks: List[Document], embedder: Embeddings) -> np.ndarray:
+    return np.asarray(embedder.embed_documents([c.page_content for c in chunks]), dtype="float32")
+
+
+def build_vectorstore(chunks: List[Document], embedder: Embeddings, ids: List[str] | None = None) -> FAISS:
+    vectors = embed_chunks(chunks, embedder)
+    db = FAISS(
+        embedder,
+        tune_index(make_index(vectors)),
+        InMemoryDocstore(),
+        {},
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+    add_chunks(db, chunks, vectors, ids or [str(i) for i in range(len(chunks))])
+    return db
+
+
+def _write_atomic(*files: Tuple[pathlib.Path, Callable[[str], None]]) -> None:
+    """For each (target, write) pair call `write(tmp)` on a temp file next to
+    target, then rename them all into place, in order.
+
+    Workers that memory-mapped an old file keep its inode; rewriting it in
+    place would truncate the pages under them (SIGBUS on their next search).
+    """
+    tmps: List[str] = []
+    try:
+        for target, write in files:
+            fd, tmp = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.")
+            os.close(fd)
+            tmps.append(tmp)
+            write(tmp)
+        for (target, _), tmp in zip(files, tmps):
+            os.replace(tmp, target)
+    except BaseException:
+        for tmp in tmps:
+            with suppress(OSError):
+                os.unlink(tmp)
+        raise
+
+
+def save_vectorstore(db: FAISS, path: pathlib.Path, *extra: Tuple[pathlib.Path, Callable[[str], None]]) -> None:
+    """Write the `save_local` layout, then `extra` files, each replaced atomically."""
+    path.mkdir(parents=True, exist_ok=True)
+
+    def dump(tmp: str) -> None:
+        with open(tmp, "wb") as f:
+            pickle.dump((db.docstore, db.index_to_docstore_id), f)
+
+    _write_atomic((path / "index.faiss", lambda tmp: faiss.write_index(db.index, tmp)), (path / "index.pkl", dump), *extra)
+
+
+def load_vectorstore(path: pathlib.Path, embedder: Embeddings, mmap: bool = True) -> FAISS:
+    """Load a `save_local` directory, by default with the index memory-mapped read-only.
+
+    IO_FLAG_MMAP_IFC maps the whole file, so flat codes and IVF lists alike are
+    faulted in lazily and shared through the page cache; several workers
+    serving the same index don't each hold a private copy. (IO_FLAG_MMAP maps
+    only IVF inverted lists and fails on IVF when combined with _IFC.)
+    """
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if mmap else 0
+    index = faiss.read_index(str(path / "index.faiss"), flags)
+    with open(path / "index.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(
+        embedder,
+        tune_index(index),
+        docstore,
+        index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
+# ─────────────────────────── Incremental ingest ──────────────────────────────
+
+MANIFEST = "manifest.json"  # config, built index and per-file digests, next to index.faiss
+
+
+def _index_config() -> dict:
+    # changing any of these invalidates every stored vector
+    return {
+        "embed_model": EMBED_MODEL,
+        "embed_backend": EMBED_BACKEND,
+        "embed_quantize": EMBED_QUANTIZE,
+        "faiss_index": FAISS_INDEX,
+        "chunk_size": CHUNK_SIZE,
+    }
+
+
+def file_digest(path: str) -> str:
+    # the path is hashed in too, so identical files in two places get distinct chunk ids
+    h = hashlib.blake2b(path.encode("utf-8"), digest_size=16)
+    h.update(b"\0")
+    h.update(pathlib.Path(path).read_bytes())
+    return h.hexdigest()
+
+
+def fingerprint(paths: List[str], previous: Dict[str, dict]) -> Dict[str, dict]:
+    """Digest every file, reusing the previous digest when the mtime is unchanged."""
+    out = {}
+    for p in paths:
+        mtime = os.stat(p).st_mtime_ns
+        old = previous.get(p)
+        digest = old["digest"] if old and old["mtime_ns"] == mtime else file_digest(p)
+        out[p] = {"mtime_ns": mtime, "digest": digest}
+    return out
+
+
+def chunk_ids(entry: dict) -> List[str]:
+    return [f"{entry['digest']}-{i}" for i in range(entry["chunks"])]
+
+
+def read_manifest(path: pathlib.Path) -> dict:
+    """Return the stored manifest, or {} when it is missing or was built with other settings."""
+    try:
+        manifest = json.loads((path / MANIFEST).read_text())
+    except (OSError, ValueError):
+        return {}
+    if manifest.get("config") != _index_config() or "index" not in manifest or not (path / "index.faiss").exists():
+        return {}
+    return manifest
+
+
+def manifest_file(path: pathlib.Path, files: Dict[str, dict], index: dict) -> Tuple[pathlib.Path, Callable[[str], None]]:
+    manifest = {"config": _index_config(), "index": index, "files": files}
+    return path / MANIFEST, lambda tmp: pathlib.Path(tmp).write_text(json.dumps(manifest, indent=1))
+
+
+def write_manifest(path: pathlib.Path, files: Dict[str, dict], index: dict) -> None:
+    _write_atomic(manifest_file(path, files, index))
+
+
+def index_version(path: pathlib.Path) -> str:
+    """Short digest of what the index under `path` holds; changes on every re-ingest that alters it."""
+    manifest = read_manifest(path)
+    if not manifest:
+        return "none"
+    files = sorted(entry["digest"] for entry in manifest["files"].values())
+    raw = json.dumps([manifest["config"], manifest["index"], files], sort_keys=True)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def sync_vectorstore(
+    path: pathlib.Path,
+    paths: List[str],
+    docs: List[Document],
+    splitter: RecursiveCharacterTextSplitter,
+    embedder: Embeddings,
+) -> FAISS:
+    """Bring the index under `path` in line with `paths`, embedding only new or changed files.
+
+    The whole index is rebuilt when there is none yet, when the index type
+    cannot remove chunks, or when the corpus no longer fits what the index
+    was trained for (see `index_outdated`).
+
+    Runs under a lock in `path`, and the manifest is replaced only after the
+    index files, so a sync that dies midway is redone on the next start.
+    """
+    with file_lock(path / ".lock"):
+        return _sync_vectorstore(path, paths, docs, splitter, embedder)
+
+
+def _sync_vectorstore(
+    path: pathlib.Path,
+    paths: List[str],
+    docs: List[Document],
+    splitter: RecursiveCharacterTextSplitter,
+    embedder: Embeddings,
+) -> FAISS:
+    manifest = read_manifest(path)
+    old = manifest.get("files", {})
+    new = fingerprint(paths, old)
+    fresh = [p for p in new if p not in old or old[p]["digest"] != new[p]["digest"]]
+    stale = [p for p in old if p not in new or old[p]["digest"] != new[p]["digest"]]
+    for p in new.keys() - set(fresh):
+        new[p]["chunks"] = old[p]["chunks"]
+
+    by_source: Dict[str, List[Document]] = {}
+    for d in docs:
+        by_source.setdefault(d.metadata.get("source"), []).append(d)
+
+    def split(files: List[str]):
+        chunks: List[Document] = []
+        ids: List[str] = []
+        for p in files:
+            file_chunks = splitter.split_documents(by_source.get(p, []))
+            new[p]["chunks"] = len(file_chunks)
+            chunks.extend(file_chunks)
+            ids.extend(chunk_ids(new[p]))
+        return chunks, ids
+
+    chunks, ids = split(fresh)
+    total = sum(entry["chunks"] for entry in new.values())
+    built = manifest.get("index")
+
+    rebuild = not manifest
+    if built and index_outdated(built["spec"], built["trained_on"], total):
+        log.info("Index %s (trained on %d chunks) no longer fits %d chunks – rebuilding", built["spec"], built["trained_on"], total)
+        rebuild = True
+    elif built:
+        db = load_vectorstore(path, embedder, mmap=not (fresh or stale))
+        if db.index.ntotal != len(db.index_to_docstore_id):  # died between index.faiss and index.pkl
+            log.warning("index.faiss and index.pkl in %s disagree – rebuilding", path)
+            rebuild = True
+        elif not (fresh or stale):
+            if new != old:  # only mtimes moved
+                write_manifest(path, new, built)
+            log.info("Loaded FAISS index from %s", path)
+            return db
+        else:
+            try:
+                remove_chunks(db, [i for p in stale for i in chunk_ids(old[p])])
+            except RuntimeError:  # e.g. HNSW graphs cannot drop nodes
+                log.info("Index %s cannot remove chunks – rebuilding", built["spec"])
+                rebuild = True
+            else:
+                # an interrupted sync may have saved these before its manifest
+                held = {i for i in ids if isinstance(db.docstore.search(i), Document)}
+                todo = [(c, i) for c, i in zip(chunks, ids) if i not in held]
+                if todo:
+                    add_chunks(db, [c for c, _ in todo], embed_chunks([c for c, _ in todo], embedder), [i for _, i in todo])
+                log.info("Updated FAISS index: %d files re-embedded (%d chunks), %d dropped", len(fresh), len(todo), len(stale))
+
+    if rebuild:
+        chunks, ids = split(list(new))
+        db = build_vectorstore(chunks, embedder, ids)
+        built = {"spec": resolve_spec(len(chunks)), "trained_on": len(chunks)}
+        log.info("Built new %s FAISS index: %s over %d chunks", FAISS_INDEX, built["spec"], len(chunks))
+
+    save_vectorstore(db, path, manifest_file(path, new, built))  # manifest renamed last
+    return db
+
+# ─────────────────────────── Batched retrieval ───────────────────────────────
+
+def normalize_query(question: str) -> str:
+    return re.sub(r"\s+", " ", question.strip().lower())
+
+
+class SearchCache:
+    """Exact-match Redis cache: normalised question → retrieved docstore ids.
+
+    Redis errors are logged and treated as misses so retrieval never depends
+    on the cache being up. Keys include `version` (see `index_version`), so
+    results cached before a re-ingest are never served against the new index.
+    """
+
+    def __init__(self, url: str, version: str, ttl: int = SEARCH_CACHE_TTL):
+        self.redis = aioredis.from_url(url)
+        self.version = version
+        self.ttl = ttl
+
+    def _key(self, question: str, k: int) -> str:
+        raw = f"{self.version}|{EMBED_MODEL}|{FAISS_INDEX}|{k}|{normalize_query(question)}"
+        return "rag:search:" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, question: str, k: int) -> List[str] | None:
+        try:
+            raw = await self.redis.get(self._key(question, k))
+        except RedisError as exc:
+            log.warning("Search cache unavailable: %s", exc)
+            return None
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, question: str, k: int, ids: List[str]) -> None:
+        try:
+            await self.redis.setex(self._key(question, k), self.ttl, json.dumps(ids))
+        except RedisError as exc:
+            log.warning("Search cache unavailable: %s", exc)
+
+    async def close(self) -> None:
+        await self.redis.aclose()
+
+
+class QueryBatcher:
+    """Coalesce concurrent questions into one embed call and one `index.search`."""
+
+    def __init__(self, db: FAISS, embedder: Embeddings, k: int = K, cache: SearchCache | None = None):
+        self.db = db
+        self.embedder = embedder
+        self.k = k
+        self.cache = cache
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._worker: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._worker
+
+    async def search(self, question: str) -> Tuple[List[Document], np.ndarray | None]:
+        """Return the top-k chunks and the (1, d) question embedding.
+
+        The embedding is None when the result came from the search cache.
+        """
+        store = self.db.docstore
+        if self.cache is not None and (ids := await self.cache.get(question, self.k)) is not None:
+            docs = [store.search(i) for i in ids]
+            if all(isinstance(d, Document) for d in docs):  # ids may predate a re-index
+                return docs, None
+
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((question, fut))
+        ids, vec = await fut
+
+        if self.cache is not None:
+            await self.cache.set(question, self.k, ids)
+        return [store.search(i) for i in ids], vec
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + BATCH_WINDOW_MS / 1000
+            while len(batch) < MAX_BATCH and (timeout := deadline - loop.time()) > 0:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            questions, futures = zip(*batch)
+            try:
+                results = await asyncio.to_thread(self._search_batch, list(questions))
+            except Exception as exc:
+                log.error("Batched search failure: %s", exc)
+                results = [exc] * len(futures)
+
+            for fut, res in zip(futures, results):
+                if fut.done():  # caller went away
+                    continue
+                if isinstance(res, Exception):
+                    fut.set_exception(res)
+                else:
+                    fut.set_result(res)
+
+    def _search_batch(self, questions: List[str]) -> List[Tuple[List[str], np.ndarray]]:
+        """Return the docstore ids of the top-k chunks and the embedding of each question."""
+        xq = np.asarray(self.embedder.embed_documents(questions), dtype="float32")
+        _, ids = self.db.index.search(xq, self.k)
+        id_map = self.db.index_to_docstore_id
+        return [([id_map[i] for i in row if i != -1], xq[n:n + 1]) for n, row in enumerate(ids)]
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    raw_docs = load_documents(DOCS_DIR)
+    faiss.omp_set_num_threads(NUM_THREADS)
+    log.info("Using %d compute threads", NUM_THREADS)
+    # import g4f and resolve its provider in a thread, overlapping the ingest below
+    # (run_in_executor submits now; a to_thread task would wait for the first await)
+    g4f_warmup = asyncio.get_running_loop().run_in_executor(None, g4f_backend)
+
+    paths = source_files(DOCS_DIR)
+    raw_docs = load_files(paths) if paths else FALLBACK_DOCS
+    log.info("Loaded %d raw docs from %s", len(raw_docs), DOCS_DIR)
 
-    embedder = HuggingFaceEmbeddings(model_name=EMBED_MODEL, cache_folder="/tmp/hf_cache")
+    embedder = make_embedder()
     splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=100)
-    chunks = splitter.split_documents(raw_docs)
 
-    if VECTOR_PATH.exists():
-        db = FAISS.load_local(str(VECTOR_PATH), embedder, allow_dangerous_deserialization=True)
-        log.info("Loaded FAISS index from %s", VECTOR_PATH)
-    else:
-        db = FAISS.from_documents(chunks, embedder)
-        db.save_local(str(VECTOR_PATH))
-        log.info("Built & saved new FAISS index (%d chunks)", len(chunks))
+    if paths:
+        db = sync_vectorstore(VECTOR_PATH, paths, raw_docs, splitter, embedder)
+    else:  # fallback docs only – nothing worth persisting
+        db = build_vectorstore(splitter.split_documents(raw_docs), embedder)
+
+    version = index_version(VECTOR_PATH) if paths else "fallback"
+    search_cache = SearchCache(REDIS_URL, version) if REDIS_URL else None
+    batcher = QueryBatcher(db, embedder, cache=search_cache)
+    batcher.start()
+
+    # previews are all /ingested_docs needs; drop the full texts afterwards
+    app.state.doc_previews = [
+        {
+            "id": i,
+            "source": d.metadata.get("source", "unknown"),
+            "chars": len(d.page_content),
+            "preview": d.page_content[:160].replace("\n", " ") + ("…" if len(d.page_content) > 160 else ""),
+        }
+        for i, d in enumerate(raw_docs)
+    ]
+    del raw_docs
+    app.state.batcher = batcher
+    app.state.generate_cache = SemanticCache(embedder)
+    app.state.rag_cache = SemanticCache(embedder)
 
-    app.state.raw_docs = raw_docs
-    app.state.retriever = db.as_retriever(search_kwargs={"k": K})
+    try:  # finish before serving, so no request imports g4f on the event loop
+        await g4f_warmup
+    except Exception as exc:
+        log.error("g4f backend unavailable (G4F_PROVIDER=%r): %r", G4F_PROVIDER, exc)
 
     yield
 
+    await batcher.stop()
+    if search_cache is not None:
+        await search_cache.close()
+
 app = FastAPI(title="RAG Demo (gpt4free)", lifespan=lifespan)
 
 
+# ────────────────────────── Context compression ──────────────────────────────
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+_WORD_RE = re.compile(r"\w+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Split on sentence punctuation and blank lines, rejoining lines wrapped mid-sentence (as pypdf emits them)."""
+    return [
+        sentence
+        for paragraph in _PARAGRAPH_RE.split(text)
+        for sentence in _SENTENCE_RE.split(" ".join(paragraph.split()))
+        if sentence
+    ]
+
+
+def compress_context(question: str, docs: List[Document], keep: int = CONTEXT_SENTENCES) -> str:
+    """Join `docs`, keeping only the `keep` sentences per chunk that best match `question`.
+
+    Sentences are scored by the summed IDF (over all retrieved sentences) of
+    the question terms they contain and stay in their original order.
+    """
+    if keep <= 0:
+        return "\n\n".join([d.page_content for d in docs])
+
+    chunks = [split_sentences(d.page_content) for d in docs]
+    terms = [[set(_WORD_RE.findall(s.lower())) for s in chunk] for chunk in chunks]
+    df = Counter(t for chunk in terms for ts in chunk for t in ts)
+    n = sum(len(chunk) for chunk in chunks)
+    idf = {t: math.log(n / df[t]) + 1.0 for t in set(_WORD_RE.findall(question.lower())) if t in df}
+
+    parts = []
+    for sentences, sentence_terms in zip(chunks, terms):
+        if not sentences:  # whitespace-only chunk
+            continue
+        scores = [sum(idf.get(t, 0.0) for t in ts) for ts in sentence_terms]
+        best = sorted(sorted(range(len(sentences)), key=lambda i: -scores[i])[:keep])
+        parts.append(" ".join([sentences[i] for i in best]))
+    return "\n\n".join(parts)
+
+# ─────────────────────────── Semantic cache ──────────────────────────────────
+
+class SemanticCache:
+    """Answer cache keyed on prompt embeddings, so near-duplicate prompts hit.
+
+    Lookups and inserts happen on the event loop; only `embed` is meant to
+    run in a worker thread. Keys longer than the encoder's window are not
+    cached (see `fits`).
+    """
+
+    def __init__(self, embedder: Embeddings, threshold: float = SIM_THRESHOLD, max_size: int = CACHE_SIZE):
+        self.embedder = embedder
+        if isinstance(embedder, OnnxEmbeddings):
+            self.tokenizer, self.max_tokens = embedder.tokenizer, embedder.max_length
+        elif isinstance(embedder, HuggingFaceEmbeddings):
+            self.tokenizer, self.max_tokens = embedder.client.tokenizer, embedder.client.max_seq_length
+        else:
+            self.tokenizer, self.max_tokens = None, 0
+        self.threshold = threshold
+        self.max_size = max_size
+        self.index: faiss.IndexIDMap2 | None = None  # created on first insert, once dim is known
+        self.answers: OrderedDict[int, str] = OrderedDict()
+        self._next_id = 0
+
+    def fits(self, text: str) -> bool:
+        # the encoder truncates, so keys sharing their first max_tokens would embed identically
+        if self.tokenizer is None:
+            return True
+        return len(self.tokenizer(text)["input_ids"]) <= self.max_tokens
+
+    def embed(self, text: str) -> np.ndarray:
+        return np.asarray([self.embedder.embed_query(text)], dtype="float32")
+
+    def get(self, vec: np.ndarray) -> str | None:
+        if self.index is None or not self.answers:
+            return None
+        sims, ids = self.index.search(vec, 1)
+        if sims[0, 0] < self.threshold:
+            return None
+        return self.answers.get(int(ids[0, 0]))
+
+    def put(self, vec: np.ndarray, answer: str) -> None:
+        if self.index is None:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(vec.shape[1]))
+        self.index.add_with_ids(vec, np.array([self._next_id], dtype="int64"))
+        self.answers[self._next_id] = answer
+        self._next_id += 1
+
+        if len(self.answers) > self.max_size:  # evict oldest
+            old_id, _ = self.answers.popitem(last=False)
+            self.index.remove_ids(np.array([old_id], dtype="int64"))
+
+
 # ──────────────────────── g4f async wrapper ──────────────────────────────────
-async def gpt4_chat(prompt: str) -> str:
-    """Return GPT-4 response or fallback message."""
+
+@functools.lru_cache(maxsize=None)
+def g4f_backend():
+    """Import g4f (GPT-4-free chat backend) on first use and resolve G4F_PROVIDER once."""
+    import g4f
+
+    g4f.debug.logging = False
+    provider = getattr(g4f.Provider, G4F_PROVIDER) if G4F_PROVIDER else None
+    return g4f, provider
+
+
+_inflight: Dict[str, asyncio.Task] = {}  # prompt hash → pending g4f call
+
+
+async def _complete(prompt: str) -> str | None:
     try:
+        g4f, provider = await asyncio.to_thread(g4f_backend)  # cached after startup; a failed import retries off the loop
         response = await g4f.ChatCompletion.create_async(
             model="gpt-4o",
             messages=[
                 {"role": "user", "content": prompt}
             ],
+            provider=provider,
             max_tokens=MAX_TOKENS,
         )
         return response.strip()
     except Exception as exc:
         log.error("g4f failure: %s", exc)
+        return None
+
+
+async def gpt4_chat(
+    prompt: str,
+    cache: SemanticCache | None = None,
+    cache_key: str | None = None,
+    key_vec: np.ndarray | None = None,
+) -> str:
+    """Return GPT-4 response or fallback message.
+
+    With a `cache`, `cache_key` (default: the prompt) is embedded – unless
+    its embedding is passed as `key_vec` – and a sufficiently similar
+    earlier key short-circuits the g4f call; keys longer than the encoder's
+    window bypass the cache. Identical prompts already in flight share a
+    single g4f call.
+    """
+    vec = None
+    if cache is not None and not cache.fits(cache_key or prompt):
+        cache = None
+    if cache is not None:
+        vec = key_vec if key_vec is not None else await asyncio.to_thread(cache.embed, cache_key or prompt)
+        if (hit := cache.get(vec)) is not None:
+            return hit
+
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    task = _inflight.get(key)
+    owner = task is None
+    if owner:
+        task = _inflight[key] = asyncio.create_task(_complete(prompt))
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    answer = await asyncio.shield(task)  # one caller disconnecting must not cancel the others
+
+    if answer is None:
         return "I don't know."
+    if owner and vec is not None and answer:
+        cache.put(vec, answer)
+    return answer
+
+
+async def gpt4_stream(
+    prompt: str,
+    cache: SemanticCache | None = None,
+    cache_key: str | None = None,
+    key_vec: np.ndarray | None = None,
+) -> AsyncIterator[str]:
+    """Yield GPT-4 response chunks as they arrive; see `gpt4_chat` for caching.
+
+    A cache hit is yielded as a single chunk; the streamed answer is cached
+    once complete.
+    """
+    vec = None
+    if cache is not None and not cache.fits(cache_key or prompt):
+        cache = None
+    if cache is not None:
+        vec = key_vec if key_vec is not None else await asyncio.to_thread(cache.embed, cache_key or prompt)
+        if (hit := cache.get(vec)) is not None:
+            yield hit
+            return
+
+    parts: List[str] = []
+    try:
+        g4f, provider = await asyncio.to_thread(g4f_backend)
+        response = g4f.ChatCompletion.create_async(
+            model="gpt-4o",
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            provider=provider,
+            max_tokens=MAX_TOKENS,
+            stream=True,
+        )
+        if inspect.isawaitable(response):  # some providers don't stream
+            response = await response
+        if isinstance(response, str):
+            parts.append(response)
+            yield response
+        else:
+            async for chunk in response:
+                if chunk and not isinstance(chunk, Exception):
+                    parts.append(str(chunk))
+                    yield parts[-1]
+    except Exception as exc:
+        log.error("g4f failure: %s", exc)
+        if not parts:
+            yield "I don't know."
+        return
+
+    answer = "".join(parts).strip()
+    if vec is not None and answer:
+        cache.put(vec, answer)
 
 # ───────────────────────────── FastAPI app ───────────────────────────────────
 
 def _sorry(q: str):
     return {"question": q, "answer": "I don't know.", "sources": []}
 
+
+def _sse(chunks: AsyncIterator[str], **done) -> StreamingResponse:
+    """Server-sent events: one JSON-encoded `data:` per chunk, then a `done` event."""
+    async def events():
+        async for chunk in chunks:
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield f"event: done\ndata: {json.dumps(done)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
 # -------- Simple completion --------------------------------------------------
 @app.get("/generate")
-async def generate(prompt: str = Query(..., min_length=1)):
-    answer = await gpt4_chat(prompt)
+async def generate(request: Request, prompt: str = Query(..., min_length=1), stream: bool = False):
+    if stream:
+        return _sse(gpt4_stream(prompt, request.app.state.generate_cache))
+
+    answer = await gpt4_chat(prompt, request.app.state.generate_cache)
     return {"prompt": prompt, "completion": answer}
 
 # -------- RAG ----------------------------------------------------------------
 @app.get("/rag")
-async def rag(request: Request, question: str = Query(..., min_length=1)):
-    retriever = request.app.state.retriever
-    docs = retriever.get_relevant_documents(question)
+async def rag(request: Request, question: str = Query(..., min_length=1), stream: bool = False):
+    docs, question_vec = await request.app.state.batcher.search(question)
     if not docs:
         return _sorry(question)
 
-    context = "\n\n".join(d.page_content for d in docs)
+    context = compress_context(question, docs)
 
     rag_prompt = (
         "You are a helpful assistant. Read the context and answer the question. "
@@ -131,28 +1007,27 @@ async def rag(request: Request, question: str = Query(..., min_length=1)):
         f"Context:\n{context}\n\nQuestion: {question}\nAnswer:"
     )
 
-    answer = await gpt4_chat(rag_prompt)
+    srcs = list({d.metadata.get("source", "unknown") for d in docs})
+
+    # keyed on the question: the long context prompt would be truncated by the encoder;
+    # retrieval already embedded it, so the cache lookup reuses that vector
+    cache = request.app.state.rag_cache
+    if stream:
+        return _sse(gpt4_stream(rag_prompt, cache, cache_key=question, key_vec=question_vec), sources=srcs)
+
+    answer = await gpt4_chat(rag_prompt, cache, cache_key=question, key_vec=question_vec)
 
     if answer.lower().startswith("i don't know") or not answer.strip():
         return _sorry(question)
 
-    srcs = list({d.metadata.get("source", "unknown") for d in docs})
     return {"question": question, "answer": answer, "sources": srcs}
 
 # -------- Inspect docs -------------------------------------------------------
 @app.get("/ingested_docs")
 async def ingested_docs(request: Request, limit: int = Query(50, ge=1)):
-    raw_docs = request.app.state.raw_docs
-
-    out = []
-    for i, d in enumerate(raw_docs[:limit]):
-        out.append({
-            "id": i,
-            "source": d.metadata.get("source", "unknown"),
-            "chars": len(d.page_content),
-            "preview": d.page_content[:160].replace("\n", " ") + ("…" if len(d.page_content) > 160 else ""),
-        })
-    return {"total": len(raw_docs), "shown": len(out), "docs": out}
+    previews = request.app.state.doc_previews
+    out = previews[:limit]
+    return {"total": len(previews), "shown": len(out), "docs": out}
 
 # -------- CLI entry ----------------------------------------------------------
 if __name__ == "__main__":
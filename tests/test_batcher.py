@@ -0,0 +1,42 @@
+import asyncio
+import pathlib
+import sys
+
+from langchain.schema import Document
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import rag_demo_fastapi as rag  # noqa: E402
+from test_ingest import HashEmbeddings  # noqa: E402
+
+
+class BatchRecorder(HashEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def embed_documents(self, texts):
+        self.batches.append(list(texts))
+        return super().embed_documents(texts)
+
+
+def test_concurrent_questions_share_one_embed_and_search(monkeypatch):
+    monkeypatch.setattr(rag, "FAISS_INDEX", "flat")
+    texts = [f"document number {i}" for i in range(20)]
+    db = rag.build_vectorstore([Document(page_content=t) for t in texts], HashEmbeddings())
+    embedder = BatchRecorder()
+    questions = texts[:5]
+
+    async def main():
+        batcher = rag.QueryBatcher(db, embedder, k=3)
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.search(q) for q in questions))
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(main())
+
+    assert embedder.batches == [questions]
+    for question, (docs, vec) in zip(questions, results):
+        assert len(docs) == 3 and docs[0].page_content == question
+        assert vec.shape == (1, HashEmbeddings.dim)
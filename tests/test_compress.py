@@ -0,0 +1,39 @@
+import pathlib
+import sys
+
+from langchain.schema import Document
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import rag_demo_fastapi as rag  # noqa: E402
+
+
+def docs(*texts):
+    return [Document(page_content=t) for t in texts]
+
+
+def test_split_sentences_rejoins_wrapped_lines():
+    text = "The quick brown\nfox jumps over\nthe dog. Then it\nran away!\n\nHeading\n\n  Next para\nline.  "
+    assert rag.split_sentences(text) == [
+        "The quick brown fox jumps over the dog.",
+        "Then it ran away!",
+        "Heading",
+        "Next para line.",
+    ]
+
+
+def test_keeps_top_sentences_in_original_order():
+    chunk = "Cats sleep a lot. Dogs bark at night. Birds sing. Dogs chase cats. Fish swim."
+    out = rag.compress_context("why do dogs bark", docs(chunk), keep=2)
+    assert out == "Dogs bark at night. Dogs chase cats."
+
+
+def test_keep_zero_passes_chunks_through():
+    chunks = ["First chunk.\nWrapped line.", "Second chunk."]
+    assert rag.compress_context("anything", docs(*chunks), keep=0) == "\n\n".join(chunks)
+
+
+def test_empty_chunks():
+    assert rag.split_sentences("") == []
+    assert rag.split_sentences(" \n\n \n") == []
+    assert rag.compress_context("dogs", docs("", "Dogs bark. Cats purr."), keep=1) == "Dogs bark."
+    assert rag.compress_context("dogs", [], keep=1) == ""
@@ -0,0 +1,174 @@
+import hashlib
+import os
+import pathlib
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.embeddings import Embeddings
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import rag_demo_fastapi as rag  # noqa: E402
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic unit vectors keyed on the text, counting what gets embedded."""
+
+    dim = 32
+
+    def __init__(self):
+        self.embedded = []
+
+    def _vec(self, text):
+        seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+        v = np.random.default_rng(seed).standard_normal(self.dim)
+        return (v / np.linalg.norm(v)).tolist()
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [self._vec(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._vec(text)
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag, "FAISS_INDEX", "flat")
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    return docs
+
+
+def write(path, text, mtime_ns):
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def sync(store, docs, embedder, chunk_size=200):
+    paths = rag.source_files(docs)
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=0)
+    return rag.sync_vectorstore(store, paths, rag.load_files(paths), splitter, embedder)
+
+
+def indexed_texts(db):
+    assert db.index.ntotal == len(db.index_to_docstore_id)
+    return sorted(db.docstore.search(i).page_content for i in db.index_to_docstore_id.values())
+
+
+def test_sync_reembeds_only_changed_files(corpus, tmp_path):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    write(corpus / "b.txt", "bravo two", 1)
+    write(corpus / "c.txt", "charlie three", 1)
+    sync(store, corpus, HashEmbeddings())
+
+    write(corpus / "a.txt", "alpha changed", 2)
+    (corpus / "b.txt").unlink()
+    write(corpus / "d.txt", "delta four", 2)
+    embedder = HashEmbeddings()
+    db = sync(store, corpus, embedder)
+
+    assert sorted(embedder.embedded) == ["alpha changed", "delta four"]
+    assert indexed_texts(db) == ["alpha changed", "charlie three", "delta four"]
+    assert db.similarity_search("delta four", k=1)[0].page_content == "delta four"
+
+    # a fresh process sees the same index, and untouched files are not re-embedded
+    embedder = HashEmbeddings()
+    db = sync(store, corpus, embedder)
+    assert embedder.embedded == []
+    assert indexed_texts(db) == ["alpha changed", "charlie three", "delta four"]
+
+
+def test_sync_rebuilds_when_preset_becomes_trainable(corpus, tmp_path, monkeypatch):
+    monkeypatch.setattr(rag, "FAISS_INDEX", "ivfsq8")
+    monkeypatch.setitem(rag.INDEX_PRESETS, "ivfsq8", ("IVF{nlist},SQ8", 50))
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    sync(store, corpus, HashEmbeddings())
+    assert rag.read_manifest(store)["index"] == {"spec": "IDMap2,Flat", "trained_on": 1}
+
+    lines = "\n\n".join(f"line number {i}" for i in range(60))
+    write(corpus / "b.txt", lines, 2)
+    embedder = HashEmbeddings()
+    db = sync(store, corpus, embedder, chunk_size=20)
+
+    built = rag.read_manifest(store)["index"]
+    assert built["spec"].startswith("IVF") and built["trained_on"] == db.index.ntotal == 61
+    assert "alpha one" in embedder.embedded  # rebuilt from every file, not just the new one
+
+
+def test_sync_rebuilds_when_encoder_changes(corpus, tmp_path, monkeypatch):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    sync(store, corpus, HashEmbeddings())
+
+    monkeypatch.setattr(rag, "EMBED_QUANTIZE", not rag.EMBED_QUANTIZE)
+    embedder = HashEmbeddings()
+    sync(store, corpus, embedder)
+    assert embedder.embedded == ["alpha one"]
+
+
+def test_index_version_tracks_content(corpus, tmp_path):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    sync(store, corpus, HashEmbeddings())
+    before = rag.index_version(store)
+
+    write(corpus / "a.txt", "alpha one", 2)  # touched, same content
+    sync(store, corpus, HashEmbeddings())
+    assert rag.index_version(store) == before
+
+    write(corpus / "a.txt", "alpha changed", 3)
+    sync(store, corpus, HashEmbeddings())
+    assert rag.index_version(store) != before
+
+
+def test_reingest_keeps_mapped_index_readable(corpus, tmp_path):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "\n\n".join(f"line number {i}" for i in range(200)), 1)
+    sync(store, corpus, HashEmbeddings(), chunk_size=20)
+    mapped = rag.load_vectorstore(store, HashEmbeddings())  # another worker's view
+
+    write(corpus / "a.txt", "alpha", 2)  # the rewritten index is a fraction of the old size
+    sync(store, corpus, HashEmbeddings(), chunk_size=20)
+
+    # the old mapping still points at the replaced inode; a truncated file would SIGBUS here
+    assert mapped.similarity_search("line number 7", k=1)[0].page_content == "line number 7"
+
+
+def test_sync_recovers_from_interrupted_save(corpus, tmp_path):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    write(corpus / "b.txt", "bravo two", 1)
+    sync(store, corpus, HashEmbeddings())
+    old_manifest = (store / rag.MANIFEST).read_bytes()
+    old_pkl = (store / "index.pkl").read_bytes()
+
+    write(corpus / "a.txt", "alpha changed", 2)
+    write(corpus / "c.txt", "charlie three", 2)
+    sync(store, corpus, HashEmbeddings())
+    (store / rag.MANIFEST).write_bytes(old_manifest)  # died before the manifest rename
+
+    embedder = HashEmbeddings()
+    db = sync(store, corpus, embedder)
+    assert embedder.embedded == []
+    assert indexed_texts(db) == ["alpha changed", "bravo two", "charlie three"]
+
+    (store / "index.pkl").write_bytes(old_pkl)  # died between index.faiss and index.pkl
+    db = sync(store, corpus, HashEmbeddings())
+    assert indexed_texts(db) == ["alpha changed", "bravo two", "charlie three"]
+
+
+def test_concurrent_syncs_embed_once(corpus, tmp_path):
+    store = tmp_path / "index"
+    write(corpus / "a.txt", "alpha one", 1)
+    write(corpus / "b.txt", "bravo two", 1)
+    embedders = [HashEmbeddings() for _ in range(4)]
+    with ThreadPoolExecutor(len(embedders)) as pool:
+        dbs = list(pool.map(lambda e: sync(store, corpus, e), embedders))
+
+    assert sorted(t for e in embedders for t in e.embedded) == ["alpha one", "bravo two"]
+    assert all(indexed_texts(db) == ["alpha one", "bravo two"] for db in dbs)
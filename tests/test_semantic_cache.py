@@ -0,0 +1,85 @@
+import asyncio
+import pathlib
+import sys
+
+import numpy as np
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
+import rag_demo_fastapi as rag  # noqa: E402
+
+
+def unit(*xs):
+    v = np.asarray([xs], dtype="float32")
+    return v / np.linalg.norm(v)
+
+
+class WordTokenizer:
+    def __call__(self, text):
+        return {"input_ids": text.split()}
+
+
+def make_cache(**kwargs):
+    return rag.SemanticCache(embedder=None, **kwargs)
+
+
+def test_hit_above_threshold_miss_below():
+    cache = make_cache(threshold=0.9)
+    assert cache.get(unit(1, 0)) is None  # empty
+    cache.put(unit(1, 0), "east")
+
+    assert cache.get(unit(1, 0.1)) == "east"  # cos ≈ 0.995
+    assert cache.get(unit(1, 1)) is None  # cos ≈ 0.707
+
+
+def test_evicts_oldest_beyond_max_size():
+    cache = make_cache(threshold=0.99, max_size=2)
+    cache.put(unit(1, 0, 0), "x")
+    cache.put(unit(0, 1, 0), "y")
+    cache.put(unit(0, 0, 1), "z")
+
+    assert cache.get(unit(1, 0, 0)) is None
+    assert cache.get(unit(0, 1, 0)) == "y"
+    assert cache.get(unit(0, 0, 1)) == "z"
+    assert cache.index.ntotal == len(cache.answers) == 2
+
+
+def test_only_the_owner_of_an_inflight_call_fills_the_cache(monkeypatch):
+    calls = []
+
+    async def complete(prompt):
+        calls.append(prompt)
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    monkeypatch.setattr(rag, "_complete", complete)
+    cache = make_cache()
+    puts = []
+    put = cache.put
+    monkeypatch.setattr(cache, "put", lambda vec, answer: (puts.append(answer), put(vec, answer)))
+
+    async def main():
+        vecs = [unit(1, 0), unit(1, 0.01)]  # both miss, then share one g4f call
+        return await asyncio.gather(*(rag.gpt4_chat("same prompt", cache, key_vec=v) for v in vecs))
+
+    assert asyncio.run(main()) == ["answer", "answer"]
+    assert calls == ["same prompt"]
+    assert puts == ["answer"]
+
+
+def test_keys_longer_than_the_encoder_window_bypass_the_cache(monkeypatch):
+    async def complete(prompt):
+        return prompt.split()[-1]
+
+    monkeypatch.setattr(rag, "_complete", complete)
+    cache = make_cache()
+    cache.tokenizer, cache.max_tokens = WordTokenizer(), 3
+    monkeypatch.setattr(cache, "embed", lambda text: unit(*[len(w) for w in text.split()[:3]]))
+
+    async def main():
+        first = await rag.gpt4_chat("long shared preamble first", cache)
+        second = await rag.gpt4_chat("long shared preamble second", cache)
+        return first, second
+
+    assert asyncio.run(main()) == ("first", "second")  # truncated keys would collide
+    assert not cache.answers
+    assert cache.fits("short key") and not cache.fits("one two three four")